@@ -2,125 +2,502 @@
 """
 aws-csv-to-confluence
 
-Usage:
-  aws-csv-to-confluence --user USER --token TOKEN --url URL --file FILE
-                        (--parent PARENT | --parent-space SPACE --parent-title TITLE)
-                        [--subtitle SUBTITLE]
-                        [--ignore-group GROUPS]
-                        [--ignore-resource-type TYPES]
-                        [--clean]
-                        [--dry-run]
-
-Options:
-  --user USER                  Confluence user (required)
-  --token TOKEN                Atlassian token / password (required)
-  --url URL                    Base URL, e.g. https://mycorp.atlassian.net/wiki (required)
-  --parent PARENT              Confluence parent page ID (mutually exclusive with --parent-space and --parent-title)
-  --parent-space SPACE         Confluence space key (must be used with --parent-title)
-  --parent-title TITLE         Confluence parent page title (must be used with --parent-space)
-  --file FILE                  Path to the CSV file to process (required)
-  --subtitle SUBTITLE          Text inserted in square brackets after "[AWS]" in the page title
-  --ignore-group GROUPS        Comma-separated resource groups to skip (e.g. ec2,s3)
-  --ignore-resource-type TYPES Comma-separated resource types to skip (e.g. snapshot,instance)
-  --clean                      Delete stale child pages after publishing
-  --dry-run                    Do everything except call the Confluence REST API
+Publish an AWS Tag Editor CSV export to Confluence, one page per service.
+Run with --help for the list of options.
 """
 from __future__ import annotations
 
+import argparse
 import csv
+import hashlib
+import json
 import logging
-from collections import defaultdict
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
+from itertools import chain
 from pathlib import Path
-from typing import Any, Collection, Dict, List, Set
+from typing import (
+    IO,
+    Any,
+    Callable,
+    Collection,
+    Dict,
+    Iterable,
+    List,
+    Sequence,
+    Set,
+    TYPE_CHECKING,
+    TypeVar,
+)
+
+if TYPE_CHECKING:
+    # The client pulls in requests/urllib3/oauthlib; it is imported lazily in
+    # _connect() so --help and offline dry runs start quickly.
+    from atlassian import Confluence
+
+
+T = TypeVar("T")
+
+REQUIRED_COLUMNS = ("Identifier", "Tag: Name", "Type", "Region", "ARN", "Service")
+
+# Read buffer for CSV input (the default is 8 KiB).
+READ_BUFFER_BYTES = 1 << 20
+# From this size on the optional pyarrow parser is used when installed.
+ARROW_MIN_BYTES = 16 << 20
+
+# [body hash, page version] of the pages published by previous runs, keyed
+# by "<Confluence URL>/<parent id>/<title>".
+HASH_CACHE_PATH = (
+    Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache")
+    / "aws-csv-to-confluence"
+    / "hashes.json"
+)
+
+
+def _build_parser() -> argparse.ArgumentParser:
+    p = argparse.ArgumentParser(
+        prog="aws-csv-to-confluence",
+        description="Publish an AWS Tag Editor CSV export to Confluence, "
+        "one page per service.",
+    )
+    p.add_argument("--user", required=True, help="Confluence user")
+    p.add_argument("--token", required=True, help="Atlassian token / password")
+    p.add_argument(
+        "--url",
+        required=True,
+        help="Base URL, e.g. https://mycorp.atlassian.net/wiki",
+    )
+    p.add_argument(
+        "--parent",
+        metavar="PARENT",
+        help="Confluence parent page ID "
+        "(mutually exclusive with --parent-space and --parent-title)",
+    )
+    p.add_argument(
+        "--parent-space",
+        metavar="SPACE",
+        help="Confluence space key (must be used with --parent-title)",
+    )
+    p.add_argument(
+        "--parent-title",
+        metavar="TITLE",
+        help="Confluence parent page title (must be used with --parent-space)",
+    )
+    p.add_argument(
+        "--file",
+        required=True,
+        type=Path,
+        help="Path to the CSV file to process (may be gzip-compressed, *.gz)",
+    )
+    p.add_argument(
+        "--subtitle",
+        help='Text inserted in square brackets after "[AWS]" in the page title',
+    )
+    p.add_argument(
+        "--ignore-group",
+        metavar="GROUPS",
+        help="Comma-separated resource groups to skip (e.g. ec2,s3)",
+    )
+    p.add_argument(
+        "--ignore-resource-type",
+        metavar="TYPES",
+        help="Comma-separated resource types to skip (e.g. snapshot,instance)",
+    )
+    p.add_argument(
+        "--clean",
+        action="store_true",
+        help="Delete stale child pages after publishing",
+    )
+    p.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Do everything except call the Confluence REST API",
+    )
+    p.add_argument(
+        "--max-parallel",
+        metavar="N",
+        type=int,
+        default=8,
+        help="Number of concurrent Confluence requests (default: 8)",
+    )
+    p.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Republish every page, even if unchanged since the last run",
+    )
+    return p
 
-from atlassian import Confluence
-from docopt import docopt
+
+PARSER = _build_parser()
+
+
+def _parse_args(argv: Sequence[str] | None = None) -> argparse.Namespace:
+    """
+    Parse argv with PARSER and enforce the rules argparse cannot express:
+    --parent | (--parent-space SPACE --parent-title TITLE).
+    """
+    args = PARSER.parse_args(argv)
+
+    has_space_or_title = bool(args.parent_space or args.parent_title)
+    if args.parent and has_space_or_title:
+        PARSER.error("--parent cannot be combined with --parent-space/--parent-title")
+    if not args.parent and not has_space_or_title:
+        PARSER.error(
+            "either --parent or both --parent-space and --parent-title are required"
+        )
+    if has_space_or_title and not (args.parent_space and args.parent_title):
+        PARSER.error("--parent-space and --parent-title must be used together")
+
+    if args.max_parallel < 1:
+        PARSER.error("--max-parallel must be at least 1")
+    return args
 
 
 def _comma_list(val: str | None) -> set[str]:
     return {x.strip() for x in val.split(",")} if val else set()
 
 
-def csv_to_service_dict(path: str | Path) -> Dict[str, List[List[str]]]:
-    """Return {Service: [[Identifier, Tag: Name, Type, Region, ARN], …]}."""
-    required = {"Identifier", "Tag: Name", "Type", "Region", "ARN", "Service"}
-    out: Dict[str, List[List[str]]] = defaultdict(list)
-
-    with open(path, newline="") as fp:
-        rdr = csv.DictReader(fp)
-        if rdr.fieldnames is None:
-            raise ValueError("CSV has no header row")
-
-        missing = required - set(rdr.fieldnames)
-        if missing:
-            raise ValueError(f"Missing columns: {', '.join(sorted(missing))}")
-
-        for row in rdr:
-            out[row["Service"]].append(
-                [
-                    row["Identifier"],
-                    row["Tag: Name"] or "(not tagged)",
-                    row["Type"],
-                    row["Region"],
-                    row["ARN"],
-                ]
-            )
+def _open_text(path: str | Path) -> IO[str]:
+    """Open a UTF-8 file, gzip-compressed if it ends in .gz, as a text stream."""
+    if str(path).endswith(".gz"):
+        try:
+            from isal import igzip as gzip  # faster inflate, if installed
+        except ImportError:
+            import gzip
+        return gzip.open(path, "rt", newline="", encoding="utf-8")
+    return open(path, newline="", encoding="utf-8", buffering=READ_BUFFER_BYTES)
+
+
+def _parse_confluence_ts(s: str) -> datetime:
+    """
+    Parse a Confluence version timestamp such as "2024-05-01T12:34:56.789Z".
+
+    UTC timestamps are decoded by position; anything else (numeric offsets,
+    unexpected layouts) goes through datetime.fromisoformat. Raises ValueError
+    on malformed input.
+    """
+    if s[-1:] == "Z" and s[4:5] == "-" and s[10:11] == "T":
+        frac = s[20:-1] if s[19:20] == "." else ""
+        return datetime(
+            int(s[0:4]),
+            int(s[5:7]),
+            int(s[8:10]),
+            int(s[11:13]),
+            int(s[14:16]),
+            int(s[17:19]),
+            int(frac[:6].ljust(6, "0")),
+            tzinfo=timezone.utc,
+        )
+    return datetime.fromisoformat(s)
+
+
+def _load_body_hashes(path: Path) -> Dict[str, Any]:
+    try:
+        with open(path, encoding="utf-8") as fp:
+            return dict(json.load(fp))
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError, TypeError) as exc:
+        logging.getLogger(__name__).warning(
+            "Ignoring unreadable hash cache %s: %s", path, exc
+        )
+        return {}
+
+
+def _save_body_hashes(path: Path, hashes: Dict[str, Any]) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # A unique temp file per writer, so concurrent runs cannot trip over
+    # each other's os.replace(); the last one to finish wins.
+    with tempfile.NamedTemporaryFile(
+        "w", encoding="utf-8", dir=path.parent, suffix=".tmp", delete=False
+    ) as fp:
+        try:
+            json.dump(hashes, fp, indent=0, sort_keys=True)
+        except BaseException:
+            fp.close()
+            os.unlink(fp.name)
+            raise
+    os.replace(fp.name, path)
+
+
+def _size_connection_pool(
+    confluence: Confluence, url: str, max_parallel: int
+) -> None:
+    """
+    Let every worker thread keep its own keep-alive connection to url.
+
+    The client mounts an HTTPAdapter with the default pool of 10 connections
+    for its base URL; replace it with one sized for max_parallel that keeps
+    the client's retry policy.
+    """
+    from requests.adapters import HTTPAdapter
+
+    session = confluence.session
+    retries = session.get_adapter(url).max_retries
+    session.mount(
+        url,
+        HTTPAdapter(
+            pool_connections=1, pool_maxsize=max_parallel, max_retries=retries
+        ),
+    )
+
+
+def _connect(url: str, user: str, token: str, max_parallel: int) -> Confluence:
+    from atlassian import Confluence
+
+    confluence = Confluence(
+        url=url,
+        username=user,
+        password=token,
+        # Parallel publishing can hit Atlassian Cloud rate limits (HTTP 429).
+        # Keep the retries bounded: the client defaults to 1000 attempts with
+        # waits of up to 30 minutes, and also retries 413, which never heals.
+        backoff_and_retry=True,
+        retry_status_codes=[429, 503],
+        max_backoff_retries=5,
+        max_backoff_seconds=60,
+    )
+    # Not url: for *.atlassian.net the client appends /wiki and mounts its
+    # adapter on that longer prefix, which requests would prefer over ours.
+    _size_connection_pool(confluence, confluence.url, max_parallel)
+    return confluence
+
+
+def _run_parallel(
+    fn: Callable[[T], Any], items: Iterable[T], max_parallel: int
+) -> None:
+    """Call fn on every item, using up to max_parallel threads for the I/O."""
+    if max_parallel <= 1:
+        for item in items:
+            fn(item)
+        return
+    with ThreadPoolExecutor(max_workers=max_parallel) as ex:
+        # Drain the iterator so the first worker exception is re-raised here
+        for _ in ex.map(fn, items):
+            pass
+
+
+def _column_indices(header: Sequence[str] | None) -> List[int]:
+    """Return the positions of REQUIRED_COLUMNS in header."""
+    if header is None:
+        raise ValueError("CSV has no header row")
+
+    missing = set(REQUIRED_COLUMNS) - set(header)
+    if missing:
+        raise ValueError(f"Missing columns: {', '.join(sorted(missing))}")
+
+    return [header.index(name) for name in REQUIRED_COLUMNS]
+
+
+def _arrow_rows(path: str | Path) -> Iterable[Sequence[str]] | None:
+    """
+    Parse path with pyarrow and return its rows in REQUIRED_COLUMNS order,
+    or None when pyarrow is not installed.
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.csv as pacsv
+    except ImportError:
+        return None
+
+    # Validate the header with the stdlib first so a bad file produces the
+    # same error message whichever parser handles it.
+    with _open_text(path) as fp:
+        _column_indices(next(csv.reader(fp), None))
+
+    try:
+        tbl = pacsv.read_csv(
+            path,
+            read_options=pacsv.ReadOptions(
+                use_threads=True, block_size=READ_BUFFER_BYTES
+            ),
+            convert_options=pacsv.ConvertOptions(
+                include_columns=list(REQUIRED_COLUMNS),
+                column_types={name: pa.string() for name in REQUIRED_COLUMNS},
+                strings_can_be_null=False,
+            ),
+        )
+    except pa.ArrowInvalid as exc:
+        # e.g. "CSV parse error: Expected 6 columns, got 3: ..."
+        raise ValueError(str(exc)) from exc
+    return zip(*(tbl.column(name).to_pylist() for name in REQUIRED_COLUMNS))
+
+
+def _render_rows(
+    rows: Iterable[Sequence[str]],
+    indices: Iterable[int],
+    ig_groups: frozenset[str],
+    ig_types: frozenset[str],
+    width: int = 0,
+) -> Dict[str, List[str]]:
+    """
+    Group rows by service as wiki table rows; see csv_to_service_dict().
+
+    Rows shorter than *width* (the header's column count) are rejected with
+    a ValueError; blank lines are skipped.
+    """
+    log = logging.getLogger(__name__)
+    log_skips = log.isEnabledFor(logging.INFO)
+    out: Dict[str, List[str]] = {}
+    skipped_groups: set[str] = set()
+    i_id, i_tag, i_type, i_region, i_arn, i_svc = indices
+
+    # Exports are usually sorted by service, so keep the current group's
+    # append bound and only go back to the dict when the service changes.
+    last_svc: str | None = None
+    append = None
+    for row in rows:
+        if len(row) < width:
+            if not row:  # blank line
+                continue
+            line = getattr(rows, "line_num", "?")
+            raise ValueError(f"Line {line}: expected {width} columns, got {len(row)}")
+        svc = row[i_svc]
+        if svc != last_svc:
+            last_svc = svc
+            if svc in ig_groups:
+                skipped_groups.add(svc)
+                append = None
+            else:
+                group_rows = out.get(svc)
+                if group_rows is None:
+                    group_rows = out[svc] = []
+                append = group_rows.append
+        if append is None:
+            continue
+
+        rtype = row[i_type]
+        if ig_types and rtype in ig_types:
+            if log_skips:
+                log.info("Skipping %s (%s ignored)", row[i_id], rtype)
+            continue
+
+        # An f-string beats "|".join() of the fields here (BUILD_STRING
+        # skips building the tuple), so keep it.
+        append(
+            f"|{row[i_id]}|{row[i_tag] or '(not tagged)'}|{rtype}"
+            f"|{row[i_region]}|{row[i_arn]}|"
+        )
+
+    if skipped_groups:
+        log.info(
+            "Skipping groups %s (ignore list)", ", ".join(sorted(skipped_groups))
+        )
     return out
 
 
+def csv_to_service_dict(
+    path: str | Path,
+    *,
+    ignore_groups: Collection[str] = (),
+    ignore_resource_types: Collection[str] = (),
+) -> Dict[str, List[str]]:
+    """
+    Return {Service: ["|Identifier|Tag: Name|Type|Region|ARN|", …]}.
+
+    Rows are rendered straight into wiki-markup table rows while parsing;
+    ignored groups and resource types are dropped before they are formatted.
+    Files ending in .gz are decompressed on the fly. Files of ARROW_MIN_BYTES
+    or more (compressed size) are parsed with pyarrow when available.
+    """
+    ig_groups = frozenset(ignore_groups)
+    ig_types = frozenset(ignore_resource_types)
+
+    if os.path.getsize(path) >= ARROW_MIN_BYTES:
+        rows = _arrow_rows(path)
+        if rows is not None:
+            return _render_rows(rows, range(6), ig_groups, ig_types)
+
+    with _open_text(path) as fp:
+        rdr = csv.reader(fp)
+        header = next(rdr, None)
+        indices = _column_indices(header)
+        return _render_rows(rdr, indices, ig_groups, ig_types, len(header))
+
+
 def create_pages(
-    resources: Dict[str, List[List[str]]],
+    resources: Dict[str, List[str]],
     parent_id: str | int,
     subtitle: str | None,
     *,
-    ignore_groups: Collection[str],
-    ignore_resource_types: Collection[str],
-    confluence: Confluence,
+    confluence: Confluence | None,
     dry_run: bool = False,
+    max_parallel: int = 1,
+    body_hashes: Dict[str, Any] | None = None,
 ) -> Set[str]:
     """
     Publish one Confluence page per Service; return the set of titles created.
+
+    *resources* holds pre-rendered table rows as returned by
+    csv_to_service_dict(). Up to *max_parallel* pages are published at once.
+    *confluence* is not used in a dry run and may be None there.
+    When *body_hashes* ({title: [hash, version]} for this parent) is given,
+    a page is not sent again if its body hash matches the stored one and the
+    page still exists in Confluence at the stored version. The mapping is
+    updated with what was published and loses titles no longer produced.
     """
-    ig_groups = set(ignore_groups)
-    ig_types = set(ignore_resource_types)
-    header = "||ID||Tag: Name||Type||Region||ARN||"
+    header = ("||ID||Tag: Name||Type||Region||ARN||",)
+    prefix = f"[AWS] [{subtitle}] " if subtitle else "[AWS] "
     log = logging.getLogger(__name__)
     created_titles: set[str] = set()
+    pages: list[tuple[str, List[str]]] = []
 
-    for group, rows in resources.items():
-        if group in ig_groups:
-            log.info("Skipping group %s (ignore list)", group)
-            continue
-
-        body_rows = [
-            f"|{rid}|{tag}|{rtype}|{region}|{arn}|"
-            for rid, tag, rtype, region, arn in rows
-            if rtype not in ig_types or log.info("Skipping %s (%s ignored)", rid, rtype)
-        ]
-
+    # Sorted so pages are published (and logged) in a stable order
+    for group, body_rows in sorted(resources.items()):
         if not body_rows:
             log.info("Group %s: all rows filtered out — page not created", group)
             continue
 
-        title = "[AWS] "
-        if subtitle:
-            title += f"[{subtitle}] "
-        title += group
+        title = prefix + group
 
         if dry_run:
             log.info("[DRY-RUN] Would publish page %s (%d rows)", title, len(body_rows))
         else:
-            confluence.update_or_create(
-                title=title,
-                body=header + "\n" + "\n".join(body_rows),
-                representation="wiki",
-                parent_id=parent_id,
-            )
-            log.info("Published page %s (%d rows)", title, len(body_rows))
+            pages.append((title, body_rows))
 
         created_titles.add(title)
 
+    # The local cache alone cannot tell whether a page was deleted, edited by
+    # hand or republished from elsewhere; compare against the live versions.
+    live_versions: Dict[str, Any] = {}
+    if body_hashes and pages:
+        live_versions = {
+            child.get("title"): child.get("version", {}).get("number")
+            for child in confluence.get_page_child_by_type(
+                page_id=parent_id, type="page", expand="version"
+            )
+        }
+
+    def publish(page: tuple[str, List[str]]) -> None:
+        title, body_rows = page
+        body = "\n".join(chain(header, body_rows))
+        if body_hashes is not None:
+            body_hash = hashlib.blake2b(body.encode(), digest_size=16).hexdigest()
+            live = live_versions.get(title)
+            if live is not None and body_hashes.get(title) == [body_hash, live]:
+                log.info("Page %s unchanged — skipped", title)
+                return
+
+        result = confluence.update_or_create(
+            title=title,
+            body=body,
+            representation="wiki",
+            parent_id=parent_id,
+        )
+        log.info("Published page %s (%d rows)", title, len(body_rows))
+        if body_hashes is not None:
+            version = ((result or {}).get("version") or {}).get("number")
+            body_hashes[title] = [body_hash, version]
+
+    _run_parallel(publish, pages, max_parallel)
+
+    if body_hashes is not None and not dry_run:
+        # A page that is not produced this run may get deleted by clean_up;
+        # forget its hash so it is recreated if it ever comes back.
+        for title in body_hashes.keys() - created_titles:
+            del body_hashes[title]
     return created_titles
 
 
@@ -131,14 +508,23 @@ def clean_up(
     confluence: Confluence,
     *,
     dry_run: bool = False,
+    max_parallel: int = 1,
+    body_hashes: Dict[str, Any] | None = None,
 ) -> None:
     """
     Delete child pages whose title is *not* in keep_titles and whose last edit
-    precedes run_time.
+    precedes run_time. Up to *max_parallel* pages are removed at once.
+    Titles of removed pages are dropped from *body_hashes* if given.
     """
     log = logging.getLogger(__name__)
-    for page_id in confluence.get_child_id_list(page_id=parent_id):
-        meta = confluence.get_page_by_id(page_id=page_id)
+    # One paged listing with the version expanded server-side instead of a
+    # get_page_by_id() round-trip per child.
+    children = confluence.get_page_child_by_type(
+        page_id=parent_id, type="page", expand="version"
+    )
+    stale: list[tuple[str, str]] = []
+    for meta in children:
+        page_id = meta["id"]
         title = meta.get("title", "")
         if title in keep_titles:
             continue
@@ -147,7 +533,7 @@ def clean_up(
         if not edited_str:
             continue
         try:
-            edited_ts = datetime.fromisoformat(edited_str.replace("Z", "+00:00"))
+            edited_ts = _parse_confluence_ts(edited_str)
         except ValueError:
             log.warning("Could not parse timestamp %s on page %s", edited_str, title)
             continue
@@ -156,71 +542,102 @@ def clean_up(
             if dry_run:
                 log.info("[DRY-RUN] Would remove stale page %s (id %s)", title, page_id)
             else:
-                log.info("Removing stale page %s (id %s)", title, page_id)
-                confluence.remove_page(page_id=page_id)
+                stale.append((page_id, title))
+
+    def remove(page: tuple[str, str]) -> None:
+        page_id, title = page
+        log.info("Removing stale page %s (id %s)", title, page_id)
+        confluence.remove_page(page_id=page_id)
+        if body_hashes is not None:
+            body_hashes.pop(title, None)
+
+    _run_parallel(remove, stale, max_parallel)
 
 
-def main() -> None:
+def main(argv: Sequence[str] | None = None) -> None:
     logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
-    args: Dict[str, Any] = docopt(__doc__)
+    args = _parse_args(argv)
 
-    dry_run: bool = bool(args["--dry-run"])
+    dry_run: bool = args.dry_run
     if dry_run:
         logging.info(
             "Running in DRY-RUN mode — no changes will be pushed to Confluence"
         )
 
-    confluence = Confluence(
-        url=args["--url"],
-        username=args["--user"],
-        password=args["--token"],
-    )
-
-    has_parent_id = bool(args["--parent"])
-    has_space_and_title = bool(args["--parent-space"] and args["--parent-title"])
+    max_parallel: int = args.max_parallel
+    lookup_parent = args.parent is None  # --parent-space + --parent-title
 
-    if has_parent_id and has_space_and_title:
-        raise ValueError("Cannot use --parent with --parent-space and --parent-title")
+    # A dry run with a known parent ID and no clean-up never talks to
+    # Confluence, so don't even load the client.
+    confluence: Confluence | None = None
+    if not dry_run or lookup_parent or args.clean:
+        confluence = _connect(args.url, args.user, args.token, max_parallel)
 
-    if not has_parent_id and not has_space_and_title:
-        raise ValueError(
-            "Must provide either --parent or both --parent-space and --parent-title"
-        )
-
-    if has_space_and_title:
+    if lookup_parent:
         parent_page = confluence.get_page_by_title(
-            space=args["--parent-space"], title=args["--parent-title"]
+            space=args.parent_space, title=args.parent_title
         )
         if not parent_page:
             raise ValueError(
-                f"Parent page not found in space '{args['--parent-space']}' with title '{args['--parent-title']}'"
+                f"Parent page not found in space '{args.parent_space}' with title '{args.parent_title}'"
             )
         parent_id = parent_page["id"]
     else:
-        parent_id = args["--parent"]
+        parent_id = args.parent
 
     run_start = datetime.now(timezone.utc)
 
-    services = csv_to_service_dict(Path(args["--file"]))
-    created_titles = create_pages(
-        services,
-        parent_id=parent_id,
-        subtitle=args.get("--subtitle"),
-        ignore_groups=_comma_list(args.get("--ignore-group")),
-        ignore_resource_types=_comma_list(args.get("--ignore-resource-type")),
-        confluence=confluence,
-        dry_run=dry_run,
+    services = csv_to_service_dict(
+        args.file,
+        ignore_groups=_comma_list(args.ignore_group),
+        ignore_resource_types=_comma_list(args.ignore_resource_type),
     )
-
-    if args["--clean"]:
-        clean_up(
+    # The cache file is shared by every site and parent; work on this
+    # parent's {title: hash} slice and merge it back at the end.
+    all_hashes = _load_body_hashes(HASH_CACHE_PATH)
+    key_prefix = f"{args.url.rstrip('/')}/{parent_id}/"
+    body_hashes = {
+        k[len(key_prefix) :]: v
+        for k, v in all_hashes.items()
+        if k.startswith(key_prefix) and not args.no_cache
+    }
+    try:
+        created_titles = create_pages(
+            services,
             parent_id=parent_id,
-            keep_titles=created_titles,
-            run_time=run_start,
+            subtitle=args.subtitle,
             confluence=confluence,
             dry_run=dry_run,
+            max_parallel=max_parallel,
+            body_hashes=body_hashes,
         )
 
+        if args.clean:
+            clean_up(
+                parent_id=parent_id,
+                keep_titles=created_titles,
+                run_time=run_start,
+                confluence=confluence,
+                dry_run=dry_run,
+                max_parallel=max_parallel,
+                body_hashes=body_hashes,
+            )
+    finally:
+        # Keep the hashes of whatever did get published, even on failure
+        if not dry_run:
+            all_hashes = {
+                k: v for k, v in all_hashes.items() if not k.startswith(key_prefix)
+            }
+            all_hashes.update((key_prefix + t, h) for t, h in body_hashes.items())
+            try:
+                _save_body_hashes(HASH_CACHE_PATH, all_hashes)
+            except OSError as exc:
+                # Never fail (or mask the real error of) a publishing run
+                # over the cache; the next run just republishes more.
+                logging.warning(
+                    "Could not save hash cache %s: %s", HASH_CACHE_PATH, exc
+                )
+
     logging.info("Finished at %s", datetime.now(timezone.utc).isoformat())
 
 
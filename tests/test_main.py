@@ -1,11 +1,24 @@
+import gzip
 import io
+import logging
+import subprocess
+import sys
 from datetime import datetime, timedelta, timezone
 from pathlib import Path
 
 import pytest
+from atlassian import Confluence
 
+from aws_csv_to_confluence import main
 from aws_csv_to_confluence.main import (
+    PARSER,
     _comma_list,
+    _connect,
+    _load_body_hashes,
+    _parse_args,
+    _parse_confluence_ts,
+    _save_body_hashes,
+    _size_connection_pool,
     csv_to_service_dict,
     create_pages,
     clean_up,
@@ -35,9 +48,10 @@ class DummyConfluence:
         self.pages_created = []
         self.pages_removed = []
         self.page_lookup = {}
-        # Child pages we'll expose via get_child_id_list
+        # Child pages we'll expose via get_page_child_by_type
         self._children = {
             "1": {
+                "id": "1",
                 "title": "[AWS] ec2",
                 "version": {
                     "when": (datetime.now(timezone.utc) - timedelta(days=1))
@@ -46,6 +60,7 @@ class DummyConfluence:
                 },
             },
             "2": {
+                "id": "2",
                 "title": "[AWS] s3",
                 "version": {
                     "when": (datetime.now(timezone.utc) + timedelta(minutes=1))
@@ -58,15 +73,26 @@ class DummyConfluence:
     # ----- called by the app -----
     def update_or_create(self, *, title, body, representation, parent_id):
         self.pages_created.append((title, body, parent_id))
-
-    def get_child_id_list(self, *, page_id):
-        return list(self._children)
-
-    def get_page_by_id(self, *, page_id):
-        return self._children[str(page_id)]
+        # Bump (or create) the child page like Confluence would
+        page = next((c for c in self._children.values() if c["title"] == title), None)
+        if page is None:
+            page_id = str(len(self._children) + 1)
+            while page_id in self._children:
+                page_id += "0"
+            page = self._children[page_id] = {
+                "id": page_id,
+                "title": title,
+                "version": {"when": datetime.now(timezone.utc).isoformat()},
+            }
+        page["version"]["number"] = page["version"].get("number", 0) + 1
+        return page
+
+    def get_page_child_by_type(self, *, page_id, type, expand=None):
+        return iter(list(self._children.values()))
 
     def remove_page(self, *, page_id):
         self.pages_removed.append(page_id)
+        self._children.pop(str(page_id), None)
 
     def get_page_by_title(self, *, space, title):
         return self.page_lookup.get((space, title))
@@ -80,42 +106,376 @@ def test_comma_list_helper():
     assert _comma_list(None) == set()
 
 
+def test_import_does_not_load_confluence_client():
+    code = (
+        "import sys, aws_csv_to_confluence.main; "
+        "sys.exit('atlassian' in sys.modules)"
+    )
+    subprocess.run([sys.executable, "-c", code], check=True)
+
+
+def test_dry_run_with_parent_id_stays_offline(tmp_csv: Path, monkeypatch):
+    def fail(*args, **kwargs):
+        raise AssertionError("Confluence client should not be created")
+
+    monkeypatch.setattr(main, "_connect", fail)
+    main.main(
+        [
+            "--user", "u", "--token", "t", "--url", "https://x",
+            "--file", str(tmp_csv), "--parent", "42", "--dry-run",
+        ]  # fmt: skip
+    )
+
+
+def test_parser_defaults():
+    args = PARSER.parse_args(
+        ["--user", "u", "--token", "t", "--url", "https://x", "--file", "r.csv"]
+    )
+    assert args.file == Path("r.csv")
+    assert args.max_parallel == 8
+    assert not (args.clean or args.dry_run or args.no_cache)
+    assert args.parent is None and args.ignore_group is None
+
+
+@pytest.mark.parametrize(
+    "extra",
+    [
+        [],  # no parent at all
+        ["--parent", "42", "--parent-space", "DOCS"],
+        ["--parent", "42", "--parent-title", "Inventory"],
+        ["--parent", "42", "--parent-space", "DOCS", "--parent-title", "Inventory"],
+        ["--parent-space", "DOCS"],
+        ["--parent-title", "Inventory"],
+        ["--parent", "42", "--max-parallel", "0"],
+    ],
+)
+def test_parse_args_rejects_bad_parent_options(extra, capsys):
+    base = ["--user", "u", "--token", "t", "--url", "https://x", "--file", "r.csv"]
+    with pytest.raises(SystemExit) as exc:
+        _parse_args(base + extra)
+    assert exc.value.code == 2
+    assert "usage:" in capsys.readouterr().err
+
+
+def test_parse_args_accepts_parent_space_and_title():
+    base = ["--user", "u", "--token", "t", "--url", "https://x", "--file", "r.csv"]
+    args = _parse_args(base + ["--parent-space", "DOCS", "--parent-title", "Inv"])
+    assert (args.parent, args.parent_space, args.parent_title) == (None, "DOCS", "Inv")
+
+
+def test_size_connection_pool():
+    url = "https://example.atlassian.net/wiki"
+    confluence = Confluence(
+        url=url, username="u", password="p", backoff_and_retry=True
+    )
+    retries = confluence.session.get_adapter(url).max_retries
+
+    _size_connection_pool(confluence, url, 16)
+
+    adapter = confluence.session.get_adapter(url + "/rest/api/content")
+    assert adapter._pool_maxsize == 16
+    assert adapter.max_retries is retries
+
+
+@pytest.mark.parametrize(
+    "url", ["https://example.atlassian.net/wiki", "https://example.atlassian.net"]
+)
+def test_connect_bounds_retries(url: str):
+    confluence = _connect(url, "u", "p", 16)
+
+    api_url = "https://example.atlassian.net/wiki/rest/api/content"
+    adapter = confluence.session.get_adapter(api_url)
+    assert adapter._pool_maxsize == 16
+    retries = adapter.max_retries
+    assert retries.status == 5
+    assert retries.backoff_max == 60
+    assert list(retries.status_forcelist) == [429, 503]
+
+
+def test_parse_confluence_ts():
+    utc = timezone.utc
+    assert _parse_confluence_ts("2024-05-01T12:34:56.789Z") == datetime(
+        2024, 5, 1, 12, 34, 56, 789000, tzinfo=utc
+    )
+    assert _parse_confluence_ts("2024-05-01T12:34:56Z") == datetime(
+        2024, 5, 1, 12, 34, 56, tzinfo=utc
+    )
+    assert _parse_confluence_ts("2024-05-01T14:34:56.000+02:00") == datetime(
+        2024, 5, 1, 12, 34, 56, tzinfo=utc
+    )
+    with pytest.raises(ValueError):
+        _parse_confluence_ts("not a timestamp")
+
+
 def test_csv_to_service_dict(tmp_csv: Path):
     result = csv_to_service_dict(tmp_csv)
     assert set(result) == {"ec2", "s3"}  # two top-level keys
+    assert type(result) is dict  # no auto-vivifying defaultdict leaks out
     assert len(result["ec2"]) == 2  # two rows kept together
     first = result["ec2"][0]
-    assert first[:3] == ["id-111", "DB1", "instance"]  # basic mapping intact
+    assert first.startswith("|id-111|DB1|instance|")  # basic mapping intact
 
 
-def test_create_pages_filtering(monkeypatch):
-    resources = {
+def test_csv_to_service_dict_rows(tmp_csv: Path):
+    assert csv_to_service_dict(tmp_csv) == {
         "ec2": [
-            ["id-1", "R1", "instance", "us-east-1", "arn1"],
-            ["id-2", "R2", "snapshot", "us-east-1", "arn2"],
-        ],
-        "s3": [
-            ["id-3", "R3", "bucket", "us-east-1", "arn3"],
+            "|id-111|DB1|instance|us-east-2|arn:aws:ec2:...:instance/id-111|",
+            "|id-222|DB2|snapshot|us-east-2|arn:aws:ec2:...:snapshot/id-222|",
         ],
+        "s3": ["|id-333|Bucket1|bucket|us-east-1|arn:aws:s3:::bucket1|"],
     }
-    stub = DummyConfluence()
 
+
+def test_csv_to_service_dict_arrow(tmp_csv: Path, monkeypatch):
+    pytest.importorskip("pyarrow")
+    monkeypatch.setattr(main, "ARROW_MIN_BYTES", 0)
+    assert csv_to_service_dict(tmp_csv, ignore_resource_types={"snapshot"}) == {
+        "ec2": ["|id-111|DB1|instance|us-east-2|arn:aws:ec2:...:instance/id-111|"],
+        "s3": ["|id-333|Bucket1|bucket|us-east-1|arn:aws:s3:::bucket1|"],
+    }
+
+
+@pytest.mark.parametrize("use_arrow", [False, True])
+def test_csv_to_service_dict_gzip(tmp_csv: Path, monkeypatch, use_arrow: bool):
+    if use_arrow:
+        pytest.importorskip("pyarrow")
+        monkeypatch.setattr(main, "ARROW_MIN_BYTES", 0)
+    gz = tmp_csv.with_suffix(".csv.gz")
+    gz.write_bytes(gzip.compress(tmp_csv.read_bytes()))
+    assert csv_to_service_dict(gz) == csv_to_service_dict(tmp_csv)
+
+
+def test_csv_to_service_dict_filtering(tmp_csv: Path):
     # Ignore the whole group "s3" and the resource-type "snapshot"
+    result = csv_to_service_dict(
+        tmp_csv, ignore_groups={"s3"}, ignore_resource_types={"snapshot"}
+    )
+    assert set(result) == {"ec2"}
+    assert result["ec2"] == [
+        "|id-111|DB1|instance|us-east-2|arn:aws:ec2:...:instance/id-111|"
+    ]
+
+
+def test_csv_to_service_dict_logs_ignored_groups_once(tmp_path: Path, caplog):
+    path = tmp_path / "resources.csv"
+    path.write_text(
+        "Identifier,Tag: Name,Service,Type,Region,ARN\n"
+        "id-1,,s3,bucket,us-east-1,arn1\n"
+        "id-2,,iam,role,global,arn2\n"
+        "id-3,,s3,bucket,us-east-1,arn3\n"
+    )
+    with caplog.at_level(logging.INFO):
+        assert csv_to_service_dict(path, ignore_groups={"s3", "iam", "ec2"}) == {}
+    assert [r.getMessage() for r in caplog.records] == [
+        "Skipping groups iam, s3 (ignore list)"
+    ]
+
+
+@pytest.mark.parametrize("use_arrow", [False, True])
+def test_csv_to_service_dict_short_row(
+    tmp_path: Path, monkeypatch, use_arrow: bool
+):
+    if use_arrow:
+        pytest.importorskip("pyarrow")
+        monkeypatch.setattr(main, "ARROW_MIN_BYTES", 0)
+    path = tmp_path / "short.csv"
+    path.write_text(
+        "Identifier,Tag: Name,Service,Type,Region,ARN\n"
+        "id-1,x,ec2,instance,us-east-1,arn1\n"
+        "id-2,x,ec2\n"
+    )
+    match = "Expected 6 columns" if use_arrow else "Line 3: expected 6 columns"
+    with pytest.raises(ValueError, match=match):
+        csv_to_service_dict(path)
+
+
+def test_csv_to_service_dict_missing_columns(tmp_path: Path):
+    path = tmp_path / "bad.csv"
+    path.write_text("Identifier,Service\nid-1,ec2\n")
+    with pytest.raises(ValueError, match="Missing columns"):
+        csv_to_service_dict(path)
+
+
+def test_create_pages_filtering(monkeypatch):
+    resources = {
+        "ec2": ["|id-1|R1|instance|us-east-1|arn1|"],
+        "iam": [],  # every row filtered out at parse time
+    }
+    stub = DummyConfluence()
+
     created = create_pages(
         resources,
         parent_id=42,
         subtitle="prod",
-        ignore_groups={"s3"},
-        ignore_resource_types={"snapshot"},
         confluence=stub,
     )
 
     # Only one page (ec2) should be created …
     assert created == {"[AWS] [prod] ec2"}
-    # … and it should contain only the *instance* row.
+    # … and it should contain the header plus the *instance* row.
     assert len(stub.pages_created) == 1
     _, body, _ = stub.pages_created[0]
-    assert "|id-1|" in body and "|id-2|" not in body
+    assert body == "||ID||Tag: Name||Type||Region||ARN||\n|id-1|R1|instance|us-east-1|arn1|"
+
+
+def test_create_pages_parallel():
+    resources = {f"svc{i}": [f"|id-{i}|R|t|r|arn|"] for i in range(10)}
+    stub = DummyConfluence()
+
+    created = create_pages(
+        resources,
+        parent_id=42,
+        subtitle=None,
+        confluence=stub,
+        max_parallel=4,
+    )
+
+    assert len(created) == 10
+    assert {title for title, _, _ in stub.pages_created} == created
+
+
+def test_create_pages_skips_unchanged_bodies():
+    resources = {
+        "ec2": ["|id-1|R1|instance|us-east-1|arn1|"],
+        "s3": ["|id-2|R2|bucket|us-east-1|arn2|"],
+    }
+    stub = DummyConfluence()
+    hashes: dict = {}
+
+    kwargs = dict(parent_id=42, subtitle=None, confluence=stub, body_hashes=hashes)
+    first = create_pages(resources, **kwargs)
+    assert len(stub.pages_created) == 2
+    assert set(hashes) == {"[AWS] ec2", "[AWS] s3"}
+
+    # Second run: only the changed page is sent, but both titles are kept
+    resources["s3"] = ["|id-3|R3|bucket|us-east-1|arn3|"]
+    second = create_pages(resources, **kwargs)
+    assert second == first
+    assert [t for t, _, _ in stub.pages_created] == ["[AWS] ec2", "[AWS] s3", "[AWS] s3"]
+
+
+def test_pages_changed_in_confluence_are_republished():
+    resources = {
+        "ec2": ["|id-1|R1|instance|us-east-1|arn1|"],
+        "s3": ["|id-2|R2|bucket|us-east-1|arn2|"],
+    }
+    stub = DummyConfluence()
+    hashes: dict = {}
+    kwargs = dict(parent_id=42, subtitle=None, confluence=stub, body_hashes=hashes)
+    create_pages(resources, **kwargs)
+    assert hashes["[AWS] ec2"][1] == 1  # version returned by update_or_create
+
+    # Someone edits ec2 by hand and deletes s3, the CSV stays the same
+    stub._children["1"]["version"]["number"] += 1
+    del stub._children["2"]
+    stub.pages_created.clear()
+    create_pages(resources, **kwargs)
+    assert [t for t, _, _ in stub.pages_created] == ["[AWS] ec2", "[AWS] s3"]
+
+    # Nothing changed since: both are skipped
+    stub.pages_created.clear()
+    create_pages(resources, **kwargs)
+    assert stub.pages_created == []
+
+
+def test_removed_page_is_republished_when_it_returns():
+    ec2 = ["|id-1|R1|instance|us-east-1|arn1|"]
+    s3 = ["|id-2|R2|bucket|us-east-1|arn2|"]
+    stub = DummyConfluence()
+    hashes: dict = {}
+    kwargs = dict(parent_id=42, subtitle=None, confluence=stub, body_hashes=hashes)
+
+    # Run 1 publishes both pages
+    create_pages({"ec2": ec2, "s3": s3}, **kwargs)
+
+    # Run 2 has no s3 rows; clean_up deletes the s3 page
+    created = create_pages({"ec2": ec2}, **kwargs)
+    assert set(hashes) == {"[AWS] ec2"}
+    clean_up(
+        parent_id=42,
+        keep_titles=created,
+        run_time=datetime.now(timezone.utc) + timedelta(hours=1),
+        confluence=stub,
+        body_hashes=hashes,
+    )
+    assert stub.pages_removed == ["2"]
+
+    # Run 3 brings s3 back unchanged: it must be sent again
+    stub.pages_created.clear()
+    create_pages({"ec2": ec2, "s3": s3}, **kwargs)
+    assert [t for t, _, _ in stub.pages_created] == ["[AWS] s3"]
+
+
+def test_clean_up_forgets_hashes_of_removed_pages():
+    stub = DummyConfluence()
+    hashes = {"[AWS] ec2": "a", "[AWS] s3": "b"}
+
+    clean_up(
+        parent_id=42,
+        keep_titles={"[AWS] ec2"},
+        run_time=datetime.now(timezone.utc) + timedelta(hours=1),
+        confluence=stub,
+        body_hashes=hashes,
+    )
+
+    assert hashes == {"[AWS] ec2": "a"}
+
+
+def test_hash_cache_is_scoped_by_site(tmp_csv: Path, tmp_path: Path, monkeypatch):
+    stub = DummyConfluence()
+    monkeypatch.setattr(main, "_connect", lambda *args: stub)
+    monkeypatch.setattr(main, "HASH_CACHE_PATH", tmp_path / "hashes.json")
+
+    def run(url: str) -> None:
+        main.main(
+            [
+                "--user", "u", "--token", "t", "--url", url,
+                "--file", str(tmp_csv), "--parent", "42",
+            ]  # fmt: skip
+        )
+
+    run("https://staging.example.net/wiki")
+    run("https://prod.example.net/wiki")
+    assert len(stub.pages_created) == 4  # same parent ID, different sites
+
+    run("https://prod.example.net/wiki")
+    assert len(stub.pages_created) == 4  # unchanged on prod
+    assert set(_load_body_hashes(tmp_path / "hashes.json")) == {
+        f"https://{site}.example.net/wiki/42/[AWS] {svc}"
+        for site in ("staging", "prod")
+        for svc in ("ec2", "s3")
+    }
+
+
+def test_unwritable_hash_cache_only_warns(
+    tmp_csv: Path, tmp_path: Path, monkeypatch, caplog
+):
+    blocker = tmp_path / "not-a-dir"
+    blocker.write_text("")
+    stub = DummyConfluence()
+    monkeypatch.setattr(main, "_connect", lambda *args: stub)
+    monkeypatch.setattr(main, "HASH_CACHE_PATH", blocker / "cache" / "hashes.json")
+
+    main.main(
+        [
+            "--user", "u", "--token", "t", "--url", "https://x",
+            "--file", str(tmp_csv), "--parent", "42",
+        ]  # fmt: skip
+    )
+
+    assert len(stub.pages_created) == 2
+    assert "Could not save hash cache" in caplog.text
+
+
+def test_body_hashes_round_trip(tmp_path: Path):
+    path = tmp_path / "cache" / "hashes.json"
+    assert _load_body_hashes(path) == {}
+    _save_body_hashes(path, {"42/[AWS] ec2": "abc"})
+    assert _load_body_hashes(path) == {"42/[AWS] ec2": "abc"}
+    assert [p.name for p in path.parent.iterdir()] == ["hashes.json"]
+
+    path.write_text("not json")
+    assert _load_body_hashes(path) == {}
 
 
 def test_clean_up(tmp_path: Path):
@@ -134,11 +494,26 @@ def test_clean_up(tmp_path: Path):
     assert stub.pages_removed == []
 
 
+def test_clean_up_removes_stale_pages():
+    stub = DummyConfluence()
+    run_start = datetime.now(timezone.utc)
+
+    clean_up(
+        parent_id=999,
+        keep_titles=set(),
+        run_time=run_start,
+        confluence=stub,
+    )
+
+    # Page 1 was last edited yesterday and was not recreated
+    assert stub.pages_removed == ["1"]
+
+
 def test_dry_run_creates_nothing_and_removes_nothing():
     """`--dry-run` should leave Confluence untouched."""
     resources = {
-        "ec2": [["id-1", "R1", "instance", "us-east-1", "arn1"]],
-        "s3": [["id-2", "R2", "bucket", "us-east-1", "arn2"]],
+        "ec2": ["|id-1|R1|instance|us-east-1|arn1|"],
+        "s3": ["|id-2|R2|bucket|us-east-1|arn2|"],
     }
     stub = DummyConfluence()
 
@@ -147,8 +522,6 @@ def test_dry_run_creates_nothing_and_removes_nothing():
         resources,
         parent_id=42,
         subtitle=None,
-        ignore_groups=set(),
-        ignore_resource_types=set(),
         confluence=stub,
         dry_run=True,
     )